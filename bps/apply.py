@@ -8,66 +8,283 @@
 """
 Functions for applying BPS patches.
 """
-from zlib import crc32
+import os
+import mmap
+from concurrent.futures import ThreadPoolExecutor
 from bps import operations as ops
+from bps import constants as C
 from bps.validate import check_stream, CorruptFile
 from bps.io import read_bps
+from bps.util import crc32
 
 
-def apply_to_bytearrays(iterable, source_buf, target_buf):
+def _target_copy(buf, dst, src, length):
+	"""
+	Internal function.
+
+	Copies length bytes from offset src to offset dst within buf.
+
+	dst must be greater than src. The two ranges may overlap, in which case
+	bytes written early in the copy are read back later in the copy.
+	"""
+	# Because TargetCopy can be used to implement RLE-type compression, the
+	# bytes we're copying may not have been written yet when we start.
+	# However, the output is just the 'period' bytes before dst repeated over
+	# and over, so once we've copied those, we can keep doubling the part of
+	# the output we've written with slice assignments (each a single
+	# memmove) instead of copying a byte at a time.
+	#
+	# None of the individual slice assignments below overlap, so we can read
+	# them through a memoryview rather than making a temporary copy of each
+	# chunk before writing it back.
+	period = dst - src
+	have = min(period, length)
+
+	with memoryview(buf) as view:
+		buf[dst:dst+have] = view[src:src+have]
+
+		while have < length:
+			chunk = min(have, length - have)
+			buf[dst+have:dst+have+chunk] = view[dst:dst+chunk]
+			have += chunk
+
+
+# How many bytes apply_to_bytearrays() writes to the target buffer between
+# updates of its running CRC32.
+_CRC32_CHUNK_SIZE = 64 * 1024
+
+
+def _coalesce(iterable):
+	"""
+	Internal function.
+
+	Yields operations from iterable, merging runs of SourceRead operations
+	and contiguous SourceCopy operations into single operations.
+
+	Each merged run is then applied with one slice assignment rather than
+	one per operation. The operations in iterable may be modified, so this
+	should only be used on operations nobody else is using.
+	"""
+	pending = None
+
+	for item in iterable:
+		if pending is not None:
+			if item.opcode == pending.opcode == C.OP_SOURCEREAD:
+				pending.extend(item)
+				continue
+
+			if (
+					item.opcode == pending.opcode == C.OP_SOURCECOPY
+					and pending.offset + pending.bytespan == item.offset
+				):
+				pending.extend(item)
+				continue
+
+			yield pending
+
+		pending = item
+
+	if pending is not None:
+		yield pending
+
+
+def _apply_sourceread(item, source_buf, target_buf, writeOffset, bytespan):
+	target_buf[writeOffset:writeOffset+bytespan] = \
+			source_buf[writeOffset:writeOffset+bytespan]
+
+
+def _apply_targetread(item, source_buf, target_buf, writeOffset, bytespan):
+	target_buf[writeOffset:writeOffset+bytespan] = item.payload_buffer
+
+
+def _apply_sourcecopy(item, source_buf, target_buf, writeOffset, bytespan):
+	target_buf[writeOffset:writeOffset+bytespan] = \
+			source_buf[item.offset:item.offset+bytespan]
+
+
+def _apply_targetcopy(item, source_buf, target_buf, writeOffset, bytespan):
+	_target_copy(target_buf, writeOffset, item.offset, bytespan)
+
+
+# The function that applies each kind of patch hunk, indexed by its opcode.
+# Indexing this by item.opcode is much cheaper than walking an isinstance()
+# chain for every operation in the patch, and still works for subclasses of
+# the operation classes.
+_APPLY_HANDLERS = (
+		_apply_sourceread,  # C.OP_SOURCEREAD
+		_apply_targetread,  # C.OP_TARGETREAD
+		_apply_sourcecopy,  # C.OP_SOURCECOPY
+		_apply_targetcopy,  # C.OP_TARGETCOPY
+	)
+
+
+def _check_source_crc32(item, source_crc32):
+	"""
+	Internal function.
+
+	Raises CorruptFile if source_crc32, a callable returning the CRC32 of the
+	source data, doesn't match the SourceCRC32 operation item.
+	"""
+	actual = source_crc32()
+	expected = item.value
+
+	if actual != expected:
+		raise CorruptFile("Source file should have CRC32 {0:08X}, "
+				"got {1:08X}".format(expected, actual))
+
+
+def _check_target_crc32(item, target_crc32):
+	"""
+	Internal function.
+
+	Raises CorruptFile if target_crc32, the CRC32 of the target data, doesn't
+	match the TargetCRC32 operation item.
+	"""
+	actual = target_crc32
+	expected = item.value
+
+	if actual != expected:
+		raise CorruptFile("Target file should have CRC32 {0:08X}, "
+				"got {1:08X}".format(expected, actual))
+
+
+def cached_crc32(buf):
+	"""
+	Returns a callable that returns the CRC32 of buf.
+
+	The CRC32 is only calculated the first time the callable is called, so
+	this is useful as the source_crc32 parameter of apply_to_bytearrays()
+	when applying several patches to the same source data. buf must not be
+	modified afterward.
+	"""
+	crc = None
+
+	def get_crc32():
+		nonlocal crc
+		if crc is None:
+			crc = crc32(buf)
+		return crc
+
+	return get_crc32
+
+
+def apply_to_bytearrays(iterable, source_buf, target_buf, source_crc32=None):
 	"""
 	Applies the BPS patch from iterable to source_buf, producing target_buf.
 
 	iterable should be an iterable yielding BPS patch opcodes, after the
 	header.
 
-	source_buf should be a bytes object, or something impersonating one.
+	source_buf should be a bytes object, or another object supporting the
+	buffer protocol, such as a bytearray or an mmap.
+
+	target_buf should be a bytearray object, or another writable object
+	supporting the buffer protocol and slice assignment. It can start out
+	short and grow as the patch is applied, but shouldn't be longer than the
+	patch's target size: the TargetCRC32 check only covers the bytes the
+	patch wrote, not anything left over after them.
 
-	target_buf should be a bytearray object, or something impersonating one.
+	source_crc32, if given, should be a callable returning the CRC32 of
+	source_buf, such as the result method of a Future computing it in the
+	background. Otherwise, it's calculated when the SourceCRC32 opcode is
+	reached.
 	"""
 	writeOffset = 0
 
-	for item in iterable:
+	# SourceRead and SourceCopy can touch the source buffer in any order (or
+	# not at all), so the source CRC32 has to be calculated over the whole
+	# buffer in one go.
+	if source_crc32 is None:
+		source_crc32 = lambda: crc32(source_buf)
+
+	# The target buffer is always written front-to-back, so we can keep a
+	# running CRC32 of the bytes written so far, rather than making another
+	# pass over the whole buffer when we reach the TargetCRC32 opcode.
+	# Calling crc32() for every operation would cost more than it saves for
+	# patches with many small operations, though, so we only fold newly
+	# written bytes into the running CRC32 once there's a chunk's worth
+	# (while they're still in the cache), or when it's about to be needed.
+	target_crc32 = 0
+	crcOffset = 0
+
+	# Slicing a bytes object makes a copy, which we'd then copy again into
+	# target_buf. Slicing a memoryview doesn't.
+	with memoryview(source_buf) as source_view:
+
+		# Everything used in the loop below is bound to a local name, since
+		# those are quicker to look up than globals and builtins.
+		handlers = _APPLY_HANDLERS
+		update_crc32 = crc32
+		chunkSize = _CRC32_CHUNK_SIZE
+
+		for item in iterable:
+			# Some operations (like TargetRead) have to calculate their
+			# bytespan, so only ask for it once.
+			bytespan = item.bytespan
+
+			# Only headers and CRC32s have a bytespan of zero, and the
+			# TargetCRC32 check needs an up-to-date running CRC32.
+			if not bytespan or writeOffset - crcOffset >= chunkSize:
+				# Only hold a view of target_buf while hashing it: a bytearray
+				# can't be resized while it's exported, and target_buf is
+				# allowed to start out short and grow as we write to it.
+				with memoryview(target_buf)[crcOffset:writeOffset] as chunk:
+					target_crc32 = update_crc32(chunk, target_crc32)
+				crcOffset = writeOffset
 
-		if isinstance(item, ops.Header):
-			# Just the header, nothing for us to do here.
-			pass
+			opcode = item.opcode
+			if opcode is not None:
+				handlers[opcode](item, source_view, target_buf, writeOffset,
+						bytespan)
 
-		elif isinstance(item, ops.SourceRead):
-			target_buf[writeOffset:writeOffset+item.bytespan] = \
-					source_buf[writeOffset:writeOffset+item.bytespan]
+			elif isinstance(item, ops.SourceCRC32):
+				_check_source_crc32(item, source_crc32)
 
-		elif isinstance(item, ops.TargetRead):
-			target_buf[writeOffset:writeOffset+item.bytespan] = item.payload
+			elif isinstance(item, ops.TargetCRC32):
+				_check_target_crc32(item, target_crc32)
 
-		elif isinstance(item, ops.SourceCopy):
-			target_buf[writeOffset:writeOffset+item.bytespan] = \
-					source_buf[item.offset:item.offset+item.bytespan]
+			# Anything else is the header, and there's nothing for us to do
+			# with that.
 
-		elif isinstance(item, ops.TargetCopy):
-			# Because TargetCopy can be used to implement RLE-type compression,
-			# we have to copy a byte at a time rather than just slicing
-			# target_buf.
-			for i in range(item.bytespan):
-				target_buf[writeOffset+i] = target_buf[item.offset+i]
+			writeOffset += bytespan
 
-		elif isinstance(item, ops.SourceCRC32):
-			actual = crc32(source_buf)
-			expected = item.value
 
-			if actual != expected:
-				raise CorruptFile("Source file should have CRC32 {0:08X}, "
-						"got {1:08X}".format(expected, actual))
+def _map_target(target, size):
+	"""
+	Internal function.
+
+	Returns a writable mmap of the first size bytes of target, or None.
+
+	Mapping the target file lets us apply the patch straight into the file,
+	rather than building the result in memory and copying it out afterward.
+	That's only possible if target is a real, empty file opened for both
+	reading and writing. Files that already have content are never mapped,
+	so a patch that fails to apply can't clobber it.
+	"""
+	if size == 0:
+		# mmap can't map an empty region.
+		return None
 
-		elif isinstance(item, ops.TargetCRC32):
-			actual = crc32(target_buf)
-			expected = item.value
+	try:
+		fileno = target.fileno()
+		target.flush()
+		if target.tell() != 0 or os.fstat(fileno).st_size != 0:
+			return None
 
-			if actual != expected:
-				raise CorruptFile("Target file should have CRC32 {0:08X}, "
-						"got {1:08X}".format(expected, actual))
+	except (AttributeError, OSError, ValueError):
+		# io.UnsupportedOperation is an OSError.
+		return None
 
-		writeOffset += item.bytespan
+	# mmap can't map past the end of the file, so it has to be grown first.
+	os.ftruncate(fileno, size)
+	try:
+		return mmap.mmap(fileno, size, access=mmap.ACCESS_WRITE)
+
+	except (OSError, ValueError):
+		# Mapping a write-only file descriptor raises PermissionError. Put the
+		# file back the way we found it, and let the caller write it instead.
+		os.ftruncate(fileno, 0)
+		return None
 
 
 def apply_to_files(patch, source, target):
@@ -80,8 +297,12 @@ def apply_to_files(patch, source, target):
 	for the BPS patch.
 
 	target should be a writable, binary file handle, which will contain the
-	result of applying the given patch to the given source data.
+	result of applying the given patch to the given source data. If it's a
+	real file that's also readable (opened in 'w+b' mode, say), the patch is
+	applied directly to a memory-mapped view of it, as long as it's empty.
+	If the patch can't be applied, the target file is left as it was.
 	"""
+	# read_bps() pulls the whole patch into memory in one go.
 	iterable = check_stream(read_bps(patch))
 	sourceData = source.read()
 
@@ -93,14 +314,44 @@ def apply_to_files(patch, source, target):
 					sourceSize=header.sourceSize, source=source,
 					sourceDataLen=len(sourceData)))
 
-	targetData = bytearray(header.targetSize)
+	targetMap = _map_target(target, header.targetSize)
+	if targetMap is None:
+		targetData = bytearray(header.targetSize)
+	else:
+		targetData = targetMap
+
+	try:
+		# The source CRC32 doesn't depend on the patch at all, and zlib
+		# releases the GIL while hashing large buffers, so calculate it in the
+		# background while we're busy applying the patch.
+		with ThreadPoolExecutor(max_workers=1) as executor:
+			sourceCRC = executor.submit(crc32, sourceData)
 
-	apply_to_bytearrays(iterable, sourceData, targetData)
+			apply_to_bytearrays(_coalesce(iterable), sourceData,
+					targetData, sourceCRC.result)
 
-	assert len(targetData) == header.targetSize, ("Should have written {0} "
-			"bytes to target, not {1}".format(
-				header.targetSize, len(targetData)
+		assert len(targetData) == header.targetSize, ("Should have written "
+				"{0} bytes to target, not {1}".format(
+					header.targetSize, len(targetData)
+				)
 			)
-		)
 
-	target.write(targetData)
+	except BaseException:
+		if targetMap is not None:
+			# The target file was empty before it was grown to its full size
+			# for mapping, so put it back that way rather than leaving it full
+			# of partial data.
+			targetMap.close()
+			target.truncate(0)
+		raise
+
+	finally:
+		if targetMap is not None:
+			targetMap.close()
+
+	if targetMap is None:
+		target.write(targetData)
+	else:
+		# We wrote the data behind the file object's back, so move it to
+		# where it would be if we'd written the data normally.
+		target.seek(header.targetSize)
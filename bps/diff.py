@@ -14,9 +14,8 @@ For more information about the basic algorithm used here, see the article
 	https://gitorious.org/python-blip/pages/IntroToDeltaEncoding
 
 """
-from zlib import crc32
 from bps import operations as ops
-from bps.util import BlockMap
+from bps.util import BlockMap, crc32
 
 def iter_blocks(data, blocksize):
 	offset = 0
@@ -121,6 +120,11 @@ def diff_bytearrays(blocksize, source, target, metadata=""):
 		bestOpBackSpan = 0
 		bestOpForeSpan = 0
 
+		# Many candidates share the same backspan, and so the same copy
+		# offsets to measure their efficiency against. Since opbuf doesn't
+		# change until we pick an operation, only look each one up once.
+		copyOffsetsByBackSpan = {}
+
 		blockend = targetEncodingOffset + blocksize
 		block = target[targetEncodingOffset:blockend]
 
@@ -135,17 +139,26 @@ def diff_bytearrays(blocksize, source, target, metadata=""):
 				# all. Perhaps it's a hash collision?
 				continue
 
+			# A SourceRead takes at least one byte to encode, a SourceCopy at
+			# least two, so if even that can't beat the best candidate so far,
+			# don't bother building and measuring this one.
 			if sourceOffset == targetEncodingOffset:
+				if backspan + forespan <= bestOpEfficiency:
+					continue
 				candidate = ops.SourceRead(backspan+forespan)
 			else:
+				if backspan + forespan <= bestOpEfficiency * 2:
+					continue
 				candidate = ops.SourceCopy(
 						backspan+forespan,
 						sourceOffset-backspan,
 					)
 
-			lastSourceCopyOffset, lastTargetCopyOffset = (
-					opbuf.copy_offsets(backspan)
-				)
+			copyOffsets = copyOffsetsByBackSpan.get(backspan)
+			if copyOffsets is None:
+				copyOffsets = opbuf.copy_offsets(backspan)
+				copyOffsetsByBackSpan[backspan] = copyOffsets
+			lastSourceCopyOffset, lastTargetCopyOffset = copyOffsets
 
 			efficiency = candidate.efficiency(
 					lastSourceCopyOffset, lastTargetCopyOffset)
@@ -167,14 +180,20 @@ def diff_bytearrays(blocksize, source, target, metadata=""):
 				# all. Perhaps it's a hash collision?
 				continue
 
+			# A TargetCopy takes at least two bytes to encode.
+			if backspan + forespan <= bestOpEfficiency * 2:
+				continue
+
 			candidate = ops.TargetCopy(
 					backspan+forespan,
 					targetOffset-backspan,
 				)
 
-			lastSourceCopyOffset, lastTargetCopyOffset = (
-					opbuf.copy_offsets(backspan)
-				)
+			copyOffsets = copyOffsetsByBackSpan.get(backspan)
+			if copyOffsets is None:
+				copyOffsets = opbuf.copy_offsets(backspan)
+				copyOffsetsByBackSpan[backspan] = copyOffsets
+			lastSourceCopyOffset, lastTargetCopyOffset = copyOffsets
 
 			efficiency = candidate.efficiency(
 					lastSourceCopyOffset, lastTargetCopyOffset)
@@ -8,7 +8,8 @@
 """
 Tools for reading and writing BPS patches.
 """
-from struct import pack, unpack
+from io import StringIO
+from struct import Struct
 import re
 from binascii import b2a_hex, a2b_hex
 from bps import util
@@ -19,6 +20,18 @@ from bps.validate import CorruptFile, check_stream
 
 NON_HEX_DIGIT_RE = re.compile("[^0-9A-Fa-f]")
 
+# The CRC32 fields at the end of a patch are little-endian 32-bit integers.
+_UINT32 = Struct("<I")
+
+# write_bps() passes encoded hunks on to its output in blocks of about this
+# many bytes.
+_WRITE_BUFFER_SIZE = 64 * 1024
+
+# TargetRead data in BPS assembler is written as 40 bytes (80 hex digits) per
+# line, and hex-encoded this many lines at a time.
+_HEX_BYTES_PER_LINE = 40
+_HEX_LINES_PER_CHUNK = 1024
+
 
 def _expect_label(expected, actual):
 	if actual != expected:
@@ -26,15 +39,37 @@ def _expect_label(expected, actual):
 				"not {actual:r}".format(expected=expected, actual=actual))
 
 
-def _read_multiline_text(in_buf):
-	lines = []
-	while True:
-		line = in_buf.readline()
-		if line == ".\n":
-			break
-		if line.startswith("."): line = line[1:]
-		lines.append(line)
-	return "".join(lines)
+def _read_multiline_text(in_buf, text):
+	"""
+	Internal function.
+
+	Reads a block of text terminated by a line containing only ".".
+
+	in_buf should be an io.StringIO positioned at the start of a line, and
+	text should be its contents. getvalue() would copy the whole buffer on
+	every call, which adds up to quadratic time for a patch with many
+	TargetReads.
+	"""
+	start = in_buf.tell()
+
+	# Find the terminating line in one pass, rather than reading the block a
+	# line at a time.
+	if text.startswith(".\n", start):
+		end = start
+	else:
+		end = text.find("\n.\n", start)
+		if end == -1:
+			raise CorruptFile("Unterminated text block at offset "
+					"{start}".format(start=start))
+		end += 1
+
+	in_buf.seek(end + 2)
+
+	# Lines beginning with "." have an extra "." added to escape them.
+	block = text[start:end]
+	if block.startswith("."):
+		block = block[1:]
+	return block.replace("\n.", "\n")
 
 
 def read_bps(in_buf):
@@ -43,68 +78,105 @@ def read_bps(in_buf):
 
 	in_buf should implement io.IOBase, opened in 'rb' mode.
 	"""
-	# Keep track of the input file's CRC32, so we can check it at the end.
-	in_buf = util.CRCIOWrapper(in_buf)
+	# Read the whole patch up front, so TargetRead payloads can be slices of
+	# it rather than one small copy each, varints can be decoded straight
+	# from it without a read() call per byte, and its CRC32 can be checked
+	# in one pass at the end.
+	#
+	# This is deliberately a plain read() rather than an mmap: payloads are
+	# views of this buffer and can outlive the generator, so if it were a
+	# mapping, rewriting or truncating the patch file while they're still
+	# around would crash the process, and on Windows the file would stay
+	# locked.
+	data = in_buf.read()
+	view = memoryview(data)
+	decode_var_int = util.decode_var_int
 
 	# header
-	magic = in_buf.read(4)
+	magic = data[:4]
 
 	if magic != C.BPS_MAGIC:
 		raise CorruptFile("File magic should be {expected!r}, got "
 				"{actual!r}".format(expected=C.BPS_MAGIC, actual=magic))
 
-	sourcesize = util.read_var_int(in_buf)
-	targetsize = util.read_var_int(in_buf)
-	metadatasize = util.read_var_int(in_buf)
-	metadata = in_buf.read(metadatasize).decode('utf-8')
+	sourcesize, pos = decode_var_int(data, 4)
+	targetsize, pos = decode_var_int(data, pos)
+	metadatasize, pos = decode_var_int(data, pos)
+	metadata = data[pos:pos+metadatasize].decode('utf-8')
+	pos += metadatasize
 
 	yield ops.Header(sourcesize, targetsize, metadata)
 
+	# The body is decoded in one tight loop, with everything it touches
+	# bound to locals and single-byte varints decoded inline.
+	SourceRead = ops.SourceRead
+	TargetRead = ops.TargetRead
+	SourceCopy = ops.SourceCopy
+	TargetCopy = ops.TargetCopy
+	OP_SOURCEREAD = C.OP_SOURCEREAD
+	OP_TARGETREAD = C.OP_TARGETREAD
+	OP_SOURCECOPY = C.OP_SOURCECOPY
+	OPCODEMASK = C.OPCODEMASK
+	OPCODESHIFT = C.OPCODESHIFT
+
 	targetWriteOffset = 0
 	sourceRelativeOffset = 0
 	targetRelativeOffset = 0
 	while targetWriteOffset < targetsize:
-		value = util.read_var_int(in_buf)
-		opcode = value & C.OPCODEMASK
-		length = (value >> C.OPCODESHIFT) + 1
-
-		if opcode == C.OP_SOURCEREAD:
-			yield ops.SourceRead(length)
-
-		elif opcode == C.OP_TARGETREAD:
-			yield ops.TargetRead(in_buf.read(length))
+		value = data[pos]
+		if value & 0x80:
+			value &= 0x7f
+			pos += 1
+		else:
+			value, pos = decode_var_int(data, pos)
+		opcode = value & OPCODEMASK
+		length = (value >> OPCODESHIFT) + 1
+
+		if opcode == OP_SOURCEREAD:
+			yield SourceRead(length)
+
+		elif opcode == OP_TARGETREAD:
+			payload = view[pos:pos+length]
+			if len(payload) < length:
+				raise CorruptFile("Unexpected EOF reading {length} bytes of "
+						"TargetRead data at offset {start}".format(
+							length=length, start=pos))
+			pos += length
+			yield TargetRead(payload)
 
-		elif opcode == C.OP_SOURCECOPY:
-			raw_offset = util.read_var_int(in_buf)
+		else:
+			# The opcode is only two bits, so this must be one of the copy
+			# operations, and both start with a signed relative offset.
+			raw_offset = data[pos]
+			if raw_offset & 0x80:
+				raw_offset &= 0x7f
+				pos += 1
+			else:
+				raw_offset, pos = decode_var_int(data, pos)
 			offset = raw_offset >> 1
 			if raw_offset & 1:
 				offset = -offset
-			sourceRelativeOffset += offset
-			yield ops.SourceCopy(length, sourceRelativeOffset)
-			sourceRelativeOffset += length
 
-		elif opcode == C.OP_TARGETCOPY:
-			raw_offset = util.read_var_int(in_buf)
-			offset = raw_offset >> 1
-			if raw_offset & 1:
-				offset = -offset
-			targetRelativeOffset += offset
-			yield ops.TargetCopy(length, targetRelativeOffset)
-			targetRelativeOffset += length
+			if opcode == OP_SOURCECOPY:
+				sourceRelativeOffset += offset
+				yield SourceCopy(length, sourceRelativeOffset)
+				sourceRelativeOffset += length
 
-		else:
-			raise CorruptFile("Unknown opcode: {opcode:02b}".format(
-				opcode=opcode))
+			else:
+				targetRelativeOffset += offset
+				yield TargetCopy(length, targetRelativeOffset)
+				targetRelativeOffset += length
 
 		targetWriteOffset += length
 
 	# footer
-	yield ops.SourceCRC32(unpack("<I", in_buf.read(4))[0])
-	yield ops.TargetCRC32(unpack("<I", in_buf.read(4))[0])
+	yield ops.SourceCRC32(_UINT32.unpack_from(data, pos)[0])
+	yield ops.TargetCRC32(_UINT32.unpack_from(data, pos + 4)[0])
+	pos += 8
 
 	# Check the patch's CRC32.
-	actual = in_buf.crc32
-	expected = unpack("<I", in_buf.read(4))[0]
+	actual = util.crc32(view[:pos])
+	expected = _UINT32.unpack_from(data, pos)[0]
 
 	if expected != actual:
 		raise CorruptFile("Patch claims its CRC32 is {expected:08X}, but "
@@ -113,33 +185,75 @@ def read_bps(in_buf):
 			)
 
 
-def write_bps(iterable, out_buf):
+def write_bps(iterable, out_buf, validate=True):
 	"""
 	Encodes BPS patch instructions from the iterable into a patch in out_buf.
 
 	iterable should yield a sequence of BPS patch instructions.
 
 	out_buf should implement io.IOBase, opened in 'wb' mode.
+
+	If validate is False, iterable is trusted to already be a valid patch
+	(for example, the output of another function that checks its input) and
+	is not checked again.
 	"""
 	# Make sure we have a sensible stream to write.
-	iterable = check_stream(iterable)
+	if validate:
+		iterable = check_stream(iterable)
+	else:
+		iterable = iter(iterable)
 
 	# Keep track of the patch data's CRC32, so we can write it out at the end.
-	out_buf = util.CRCIOWrapper(out_buf)
+	crc = 0
 
 	sourceRelativeOffset = 0
 	targetRelativeOffset = 0
 
+	# Most hunks encode to a few bytes, so collect them in a buffer and pass
+	# them on in large blocks, updating the CRC32 once per block rather than
+	# making a write() call and a CRC32 update for each one.
+	pending = bytearray()
+
+	OP_TARGETREAD = C.OP_TARGETREAD
+	OP_SOURCECOPY = C.OP_SOURCECOPY
+	OP_TARGETCOPY = C.OP_TARGETCOPY
+	bufferSize = _WRITE_BUFFER_SIZE
+
 	for item in iterable:
-		out_buf.write(item.encode(sourceRelativeOffset, targetRelativeOffset))
+		opcode = item.opcode
+
+		if opcode == OP_TARGETREAD and item.bytespan >= bufferSize:
+			# Big TargetReads are passed on straight from their payload
+			# chunks, after flushing the buffer, instead of being joined
+			# together and copied into it first.
+			chunks = item.encode_chunks(
+					sourceRelativeOffset, targetRelativeOffset)
+
+		else:
+			pending += item.encode(sourceRelativeOffset, targetRelativeOffset)
 
-		if isinstance(item, ops.SourceCopy):
-			sourceRelativeOffset = item.offset + item.bytespan
-		elif isinstance(item, ops.TargetCopy):
-			targetRelativeOffset = item.offset + item.bytespan
+			if opcode == OP_SOURCECOPY:
+				sourceRelativeOffset = item.offset + item.bytespan
+			elif opcode == OP_TARGETCOPY:
+				targetRelativeOffset = item.offset + item.bytespan
+
+			if len(pending) < bufferSize:
+				continue
+			chunks = ()
+
+		crc = util.crc32(pending, crc)
+		out_buf.write(pending)
+		pending = bytearray()
+
+		for chunk in chunks:
+			crc = util.crc32(chunk, crc)
+			out_buf.write(chunk)
+
+	crc = util.crc32(pending, crc)
+	out_buf.write(pending)
 
 	# Lastly, write out the patch CRC32.
-	out_buf.write(pack("<I", out_buf.crc32))
+	out_buf.write(_UINT32.pack(crc))
 
 
 def read_bps_asm(in_buf):
@@ -148,6 +262,11 @@ def read_bps_asm(in_buf):
 
 	in_buf should implement io.IOBase, opened in 'rt' mode.
 	"""
+	# BPS assembler is a text format with no size limits on metadata or
+	# TargetRead blocks, so read it all in at once and parse it from memory.
+	text = in_buf.read()
+	in_buf = StringIO(text)
+
 	# header
 	magic = in_buf.readline()
 
@@ -166,7 +285,7 @@ def read_bps_asm(in_buf):
 
 	label, _ = in_buf.readline().split(":")
 	_expect_label(C.METADATA, label)
-	metadata = _read_multiline_text(in_buf)
+	metadata = _read_multiline_text(in_buf, text)
 
 	yield ops.Header(sourcesize, targetsize, metadata)
 
@@ -180,10 +299,16 @@ def read_bps_asm(in_buf):
 			item = ops.SourceRead(length)
 
 		elif label == C.TARGETREAD:
-			data = _read_multiline_text(in_buf)
-			data = NON_HEX_DIGIT_RE.sub("", data)
-			data = data.encode('ascii')
-			data = a2b_hex(data)
+			hexText = _read_multiline_text(in_buf, text)
+			try:
+				# bytes.fromhex() skips the whitespace between lines itself,
+				# which covers everything we write.
+				data = bytes.fromhex(hexText)
+			except ValueError:
+				# Hand-edited patches might contain other separators.
+				data = a2b_hex(
+						NON_HEX_DIGIT_RE.sub("", hexText).encode('ascii')
+					)
 			item = ops.TargetRead(data)
 
 		elif label == C.SOURCECOPY:
@@ -210,16 +335,52 @@ def read_bps_asm(in_buf):
 	yield ops.TargetCRC32(int(targetcrc32, 16))
 
 
-def write_bps_asm(iterable, out_buf):
+# How write_bps_asm() writes each single-line hunk, keyed by opcode.
+_ASM_HUNK_FORMATS = {
+		C.OP_SOURCEREAD: "sourceread: {0.bytespan}\n",
+		C.OP_SOURCECOPY: "sourcecopy: {0.bytespan} {0.offset}\n",
+		C.OP_TARGETCOPY: "targetcopy: {0.bytespan} {0.offset}\n",
+	}
+
+
+def _write_hex_lines(data, out_buf):
+	"""
+	Internal function.
+
+	Writes data to out_buf as lines of hex digits.
+	"""
+	chunkSize = _HEX_BYTES_PER_LINE * _HEX_LINES_PER_CHUNK
+	lineLength = _HEX_BYTES_PER_LINE * 2
+
+	# Encode a chunk of lines at a time, so we neither create a small string
+	# per line nor one string for the whole payload.
+	with memoryview(data) as view:
+		for start in range(0, len(view), chunkSize):
+			text = b2a_hex(view[start:start+chunkSize]).decode('ascii')
+			out_buf.write("\n".join([
+					text[i:i+lineLength]
+					for i in range(0, len(text), lineLength)
+				]))
+			out_buf.write("\n")
+
+
+def write_bps_asm(iterable, out_buf, validate=True):
 	"""
 	Encodes BPS patch instructions into BPS assembler in out_buf.
 
 	iterable should yield a sequence of BPS patch instructions.
 
 	out_buf should implement io.IOBase, opened in 'wt' mode.
+
+	If validate is False, iterable is trusted to already be a valid patch
+	(for example, the output of another function that checks its input) and
+	is not checked again.
 	"""
 	# Make sure we have a sensible stream to write.
-	iterable = check_stream(iterable)
+	if validate:
+		iterable = check_stream(iterable)
+	else:
+		iterable = iter(iterable)
 
 	# header
 	header = next(iterable)
@@ -230,38 +391,30 @@ def write_bps_asm(iterable, out_buf):
 
 	# metadata
 	out_buf.write("metadata:\n")
-	lines = header.metadata.split("\n")
-	if lines[-1] == "":
-		lines.pop(-1)
-	for line in lines:
-		# Because we use a line containing only "." as the delimiter, we
-		# need to escape all the lines beginning with dots.
-		if line.startswith("."):
-			out_buf.write(".")
-		out_buf.write(line)
-		out_buf.write("\n")
+	metadata = header.metadata
+	if metadata and not metadata.endswith("\n"):
+		metadata += "\n"
+
+	# Because we use a line containing only "." as the delimiter, we need to
+	# escape all the lines beginning with dots.
+	if metadata.startswith("."):
+		out_buf.write(".")
+	out_buf.write(metadata.replace("\n.", "\n.."))
 
 	out_buf.write(".\n")
 
+	hunkFormats = _ASM_HUNK_FORMATS
+
 	for item in iterable:
-		if isinstance(item, ops.SourceRead):
-			out_buf.write("sourceread: {0.bytespan}\n".format(item))
+		opcode = item.opcode
 
-		elif isinstance(item, ops.TargetRead):
+		if opcode == C.OP_TARGETREAD:
 			out_buf.write("targetread:\n")
-			data = item.payload
-			while len(data) > 40:
-				head, data = data[:40], data[40:]
-				out_buf.write(b2a_hex(head).decode('ascii'))
-				out_buf.write("\n")
-			out_buf.write(b2a_hex(data).decode('ascii'))
-			out_buf.write("\n.\n")
-
-		elif isinstance(item, ops.SourceCopy):
-			out_buf.write("sourcecopy: {0.bytespan} {0.offset}\n".format(item))
-
-		elif isinstance(item, ops.TargetCopy):
-			out_buf.write("targetcopy: {0.bytespan} {0.offset}\n".format(item))
+			_write_hex_lines(item.payload_buffer, out_buf)
+			out_buf.write(".\n")
+
+		elif opcode is not None:
+			out_buf.write(hunkFormats[opcode].format(item))
 
 		elif isinstance(item, ops.SourceCRC32):
 			out_buf.write("sourcecrc32: {0.value:08X}\n".format(item))
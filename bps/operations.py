@@ -9,11 +9,17 @@
 Classes representing patch operations.
 """
 import copy
-from struct import pack
+from struct import Struct
 from bps import util
 from bps import constants as C
 
 
+# Hunks whose numbers each fit in a single varint byte are packed with these
+# directly, rather than going through util.encode_var_int().
+_ONE_BYTE = Struct("B")
+_TWO_BYTES = Struct("BB")
+
+
 def _classname(obj):
 	return "{0.__module__}.{0.__name__}".format(type(obj))
 
@@ -27,6 +33,10 @@ class BaseOperation:
 	# display a lot of operations on-screen at a time.
 	marker = None
 
+	# The opcode used to encode this operation in a patch hunk, if any.
+	# Comparing this is cheaper than isinstance() in tight loops.
+	opcode = None
+
 	def encode(self, sourceRelativeOffset, targetRelativeOffset):
 		"""
 		Returns a bytestring representing this operation.
@@ -142,6 +152,8 @@ class SourceRead(BaseOperation):
 
 	marker = 'sr'
 
+	opcode = C.OP_SOURCEREAD
+
 	def __init__(self, bytespan):
 		assert isinstance(bytespan, int)
 		assert bytespan > 0
@@ -167,9 +179,10 @@ class SourceRead(BaseOperation):
 		self.bytespan += other.bytespan
 
 	def encode(self, ignored, ignored2):
-		return util.encode_var_int(
-				(self.bytespan - 1) << C.OPCODESHIFT | C.OP_SOURCEREAD
-			)
+		lengthField = (self.bytespan - 1) << C.OPCODESHIFT | C.OP_SOURCEREAD
+		if lengthField < 0x80:
+			return _ONE_BYTE.pack(lengthField | 0x80)
+		return util.encode_var_int(lengthField)
 
 	def shrink(self, length):
 		if length == 0:
@@ -194,8 +207,19 @@ class TargetRead(BaseOperation):
 
 	marker = 'tR'
 
+	opcode = C.OP_TARGETREAD
+
 	def __init__(self, payload):
-		assert isinstance(payload, bytes)
+		# A memoryview lets a patch reader hand us a slice of the patch it
+		# already has in memory, rather than a copy of it. We only keep
+		# read-only, flat views of plain bytes; anything else (a view of
+		# somebody's bytearray, or of an array whose len() counts something
+		# other than bytes) is copied, so the payload can't change under us.
+		assert isinstance(payload, (bytes, memoryview))
+		if isinstance(payload, memoryview) and not (payload.readonly
+				and payload.format == 'B' and payload.ndim == 1
+				and payload.c_contiguous):
+			payload = bytes(payload)
 		assert len(payload) > 0
 
 		self._payload = [payload]
@@ -217,29 +241,49 @@ class TargetRead(BaseOperation):
 		# If we have multiple byte-chunks in the payload, join them together
 		# then store the result so we don't have to do that (potentially
 		# expensive) operation again.
-		if len(self._payload) > 1:
+		if len(self._payload) > 1 or not isinstance(self._payload[0], bytes):
 			self._payload = [b''.join(self._payload)]
 		return self._payload[0]
 
+	@property
+	def payload_buffer(self):
+		"""
+		The payload as any bytes-like object, without copying it if possible.
+		"""
+		if len(self._payload) > 1:
+			return self.payload
+		return self._payload[0]
+
 	@property
 	def bytespan(self):
-		return len(self.payload)
+		payload = self._payload
+		if len(payload) == 1:
+			return len(payload[0])
+		return sum(map(len, payload))
 
 	def extend(self, other):
 		if not isinstance(other, type(self)):
 			raise TypeError(
 					"Cannot extend a TargetRead with {0!r}".format(other)
 				)
-		self._payload.append(other.payload)
+		self._payload.extend(other._payload)
 
 	def encode(self, ignored, ignored2):
-		payload = self.payload
-		return b''.join([
-				util.encode_var_int(
-					(len(payload) - 1) << C.OPCODESHIFT | C.OP_TARGETREAD
-				),
-				payload,
-			])
+		# Join the opcode straight onto the payload chunks, so a merged or
+		# memoryview-backed payload is copied once rather than being joined
+		# into bytes first.
+		return b''.join(self.encode_chunks(ignored, ignored2))
+
+	def encode_chunks(self, ignored, ignored2):
+		"""
+		Returns a list of bytes-like objects that make up .encode()'s result.
+
+		This lets a writer pass a large payload on without copying it.
+		"""
+		lengthField = (self.bytespan - 1) << C.OPCODESHIFT | C.OP_TARGETREAD
+		if lengthField < 0x80:
+			return [_ONE_BYTE.pack(lengthField | 0x80), *self._payload]
+		return [util.encode_var_int(lengthField), *self._payload]
 
 	def shrink(self, length):
 		if length == 0:
@@ -327,16 +371,29 @@ class SourceCopy(_BaseCopy):
 
 	marker = 'Sc'
 
+	opcode = C.OP_SOURCECOPY
+
 	def encode(self, sourceRelativeOffset, ignored):
 		relOffset = self.offset - sourceRelativeOffset
 
+		# BPS stores the offset's magnitude shifted left by one, with the low
+		# bit set if it's negative. (This isn't zigzag encoding, which would
+		# store -1 as 1, not 3.)
+
+		lengthField = (self.bytespan - 1) << C.OPCODESHIFT | C.OP_SOURCECOPY
+		offsetField = (
+				relOffset << 1 if relOffset >= 0
+				else (-relOffset << 1) | 1
+			)
+
+		# Most copies are short and near the last one, so both numbers fit
+		# in a single byte each.
+		if lengthField < 0x80 and offsetField < 0x80:
+			return _TWO_BYTES.pack(lengthField | 0x80, offsetField | 0x80)
+
 		return b''.join([
-				util.encode_var_int(
-					(self.bytespan - 1) << C.OPCODESHIFT | C.OP_SOURCECOPY
-				),
-				util.encode_var_int(
-					(abs(relOffset) << 1) | (relOffset < 0)
-				),
+				util.encode_var_int(lengthField),
+				util.encode_var_int(offsetField),
 			])
 
 	def encoded_size(self, lastSourceCopyOffset, ignored):
@@ -345,7 +402,8 @@ class SourceCopy(_BaseCopy):
 		return util.measure_var_int(
 				(self.bytespan - 1) << C.OPCODESHIFT | C.OP_SOURCECOPY
 			) + util.measure_var_int(
-				(abs(relOffset) << 1) | (relOffset < 0)
+				relOffset << 1 if relOffset >= 0
+				else (-relOffset << 1) | 1
 			)
 
 
@@ -353,16 +411,25 @@ class TargetCopy(_BaseCopy):
 
 	marker = 'TC'
 
+	opcode = C.OP_TARGETCOPY
+
 	def encode(self, ignored, targetRelativeOffset):
 		relOffset = self.offset - targetRelativeOffset
 
+		lengthField = (self.bytespan - 1) << C.OPCODESHIFT | C.OP_TARGETCOPY
+		offsetField = (
+				relOffset << 1 if relOffset >= 0
+				else (-relOffset << 1) | 1
+			)
+
+		# Most copies are short and near the last one, so both numbers fit
+		# in a single byte each.
+		if lengthField < 0x80 and offsetField < 0x80:
+			return _TWO_BYTES.pack(lengthField | 0x80, offsetField | 0x80)
+
 		return b''.join([
-				util.encode_var_int(
-					(self.bytespan - 1) << C.OPCODESHIFT | C.OP_TARGETCOPY
-				),
-				util.encode_var_int(
-					(abs(relOffset) << 1) | (relOffset < 0)
-				),
+				util.encode_var_int(lengthField),
+				util.encode_var_int(offsetField),
 			])
 
 	def encoded_size(self, ignored, lastTargetCopyOffset):
@@ -371,7 +438,8 @@ class TargetCopy(_BaseCopy):
 		return util.measure_var_int(
 				(self.bytespan - 1) << C.OPCODESHIFT | C.OP_TARGETCOPY
 			) + util.measure_var_int(
-				(abs(relOffset) << 1) | (relOffset < 0)
+				relOffset << 1 if relOffset >= 0
+				else (-relOffset << 1) | 1
 			)
 
 
@@ -406,7 +474,7 @@ class _BaseCRC32(BaseOperation):
 			)
 
 	def encode(self, ignored, ignored2):
-		return pack("<I", self.value)
+		return self.value.to_bytes(4, 'little')
 
 	def shrink(self, length):
 		raise TypeError(
@@ -436,9 +504,9 @@ def op_sequence_efficiency(oplist, lastSourceCopyOffset, lastTargetCopyOffset):
 		total_encoded_size += op.encoded_size(
 				lastSourceCopyOffset, lastTargetCopyOffset)
 
-		if isinstance(op, SourceCopy):
+		if op.opcode == C.OP_SOURCECOPY:
 			lastSourceCopyOffset = op.offset + op.bytespan
-		elif isinstance(op, TargetCopy):
+		elif op.opcode == C.OP_TARGETCOPY:
 			lastTargetCopyOffset = op.offset + op.bytespan
 
 	if total_encoded_size:
@@ -477,9 +545,9 @@ class OpBuffer:
 
 		writeOffset += operation.bytespan
 
-		if isinstance(operation, SourceCopy):
+		if operation.opcode == C.OP_SOURCECOPY:
 			lastSourceCopyOffset = operation.offset + operation.bytespan
-		elif isinstance(operation, TargetCopy):
+		elif operation.opcode == C.OP_TARGETCOPY:
 			lastTargetCopyOffset = operation.offset + operation.bytespan
 
 		self._buf.append( (operation, writeOffset, lastSourceCopyOffset,
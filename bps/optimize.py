@@ -8,79 +8,99 @@
 """
 Tools for optimizing BPS patches.
 """
-from io import BytesIO
 from bps import operations as ops
+from bps import constants as C
 from bps.validate import check_stream
 
-def optimize(iterable):
+def optimize(iterable, validate=True):
 	"""
 	Yields a simplified sequence of patch operations from iterable.
+
+	If validate is False, iterable is trusted to already be a valid patch
+	(for example, the output of check_stream()) and is not checked again.
 	"""
-	iterable = check_stream(iterable)
+	if validate:
+		iterable = check_stream(iterable)
+	else:
+		iterable = iter(iterable)
 
 	header = next(iterable)
 	yield header
 
-	lastItem = next(iterable)
+	firstItem = next(iterable)
 
-	if isinstance(lastItem, ops.SourceCopy) and lastItem.offset == 0:
+	if firstItem.opcode == C.OP_SOURCECOPY and firstItem.offset == 0:
 		# SourceCopy is copying from the start of the file, so it might as well
 		# be a SourceRead.
-		lastItem = ops.SourceRead(lastItem.bytespan)
+		firstItem = ops.SourceRead(firstItem.bytespan)
+
+	yield from _merge_hunks(iterable, firstItem)
+
+
+def _merge_hunks(iterable, lastItem):
+	"""
+	Internal function.
+
+	Yields lastItem and the rest of iterable, merging operations where
+	possible.
+
+	This is optimize()'s main loop, kept apart from its one-off setup so
+	that it's nothing but the per-item work.
+	"""
+	# lastItem's opcode is kept in a local, since it's checked at least once
+	# for every item and only changes when lastItem does.
+	lastOpcode = lastItem.opcode
 
+	# The opcodes are compared against on every iteration, so look them up
+	# once rather than going through the constants module each time.
+	OP_SOURCEREAD = C.OP_SOURCEREAD
+	OP_TARGETREAD = C.OP_TARGETREAD
+	OP_SOURCECOPY = C.OP_SOURCECOPY
+	SourceRead = ops.SourceRead
+
+	# This is deliberately a one-item-at-a-time loop rather than, say,
+	# itertools.groupby() on the opcode: most real patches alternate between
+	# operation types, so nearly every group would hold a single item, and
+	# the grouping machinery costs more than the comparisons it replaces.
 	targetWriteOffset = 0
 	for item in iterable:
+		opcode = item.opcode
 
 		if (
-				isinstance(lastItem, ops.SourceRead) and
-				isinstance(item, ops.SourceRead)
+				opcode == OP_SOURCECOPY and
+				item.offset == targetWriteOffset + lastItem.bytespan
 			):
-			# We can merge consecutive SourceRead operations.
-			lastItem.extend(item)
-			continue
+			# A SourceRead is just a SourceCopy that implicitly has its read
+			# offset set to the offset it writes to. Converting it as it
+			# arrives, rather than when it's yielded, also lets it merge with
+			# the SourceReads around it.
+			item = SourceRead(item.bytespan)
+			opcode = OP_SOURCEREAD
 
-		elif (
-				isinstance(lastItem, ops.TargetRead) and
-				isinstance(item, ops.TargetRead)
-			):
-			# We can merge consecutive TargetRead operations.
-			lastItem.extend(item)
-			continue
-
-		elif (
-				isinstance(lastItem, ops.SourceCopy) and
-				isinstance(item, ops.SourceCopy) and
-				lastItem.offset + lastItem.bytespan == item.offset
-			):
-			# We can merge consecutive SourceCopy operations, as long as the
-			# following ones have a relative offset of 0 from the end of the
-			# previous one.
-			lastItem.extend(item)
-			continue
-
-		elif (
-				isinstance(lastItem, ops.TargetCopy) and
-				isinstance(item, ops.TargetCopy) and
-				lastItem.offset + lastItem.bytespan == item.offset
-			):
-			# We can merge consecutive TargetCopy operations, as long as the
-			# following ones have a relative offset of 0 from the end of the
-			# previous one.
-			lastItem.extend(item)
-			continue
+		# Header and CRC32 operations have no opcode, and are never merged.
+		if opcode is not None and opcode == lastOpcode:
+			if opcode == OP_TARGETREAD:
+				# We can merge consecutive TargetRead operations.
+				lastItem.extend(item)
+				continue
 
-		if (
-				isinstance(lastItem, ops.SourceCopy) and
-				lastItem.offset == targetWriteOffset
-			):
-			# A SourceRead is just a SourceCopy that implicitly has its read
-			# off set set to targetWriteOffset.
-			lastItem = ops.SourceRead(lastItem.bytespan)
+			if (
+					opcode == OP_SOURCEREAD or
+					lastItem.offset + lastItem.bytespan == item.offset
+				):
+				# We can merge consecutive SourceRead operations, and
+				# consecutive SourceCopy or TargetCopy operations as long as
+				# the following ones have a relative offset of 0 from the end
+				# of the previous one. We've already checked everything
+				# extend() would, so just grow lastItem in place.
+				lastItem.bytespan += item.bytespan
+				continue
 
 		yield lastItem
 
 		targetWriteOffset += lastItem.bytespan
 
 		lastItem = item
+		lastOpcode = opcode
 
 	yield lastItem
@@ -8,13 +8,17 @@
 # http://sam.zoy.org/wtfpl/COPYING for more details.
 
 import unittest
+import os.path
 from pkgutil import get_data
 from io import BytesIO
+from tempfile import TemporaryFile, TemporaryDirectory
 from bps import operations as ops
-from bps.apply import apply_to_bytearrays, apply_to_files
-from bps.io import read_bps
-from bps.validate import check_stream
+from bps.apply import apply_to_bytearrays, apply_to_files, cached_crc32, \
+		_coalesce
+from bps.io import read_bps, write_bps
+from bps.validate import check_stream, CorruptFile
 from bps.test.util import find_bps, find_data
+from bps.util import crc32
 
 class TestApplyToByteArrays(unittest.TestCase):
 
@@ -105,6 +109,202 @@ class TestApplyToByteArrays(unittest.TestCase):
 
 		self.assertSequenceEqual(b'AAAAA', target)
 
+	def testPatchWithNonOverlappingTargetCopy(self):
+		"""
+		A TargetCopy that doesn't overlap the bytes it writes is handled.
+		"""
+		iterable = check_stream([
+				ops.Header(2, 4),
+				ops.SourceRead(2),
+				ops.TargetCopy(2, 0),
+				ops.SourceCRC32(0x30694C07),
+				ops.TargetCRC32(0x0042E712),
+			])
+		source = b'AB'
+		target = bytearray(4)
+
+		apply_to_bytearrays(iterable, source, target)
+
+		self.assertSequenceEqual(b'ABAB', target)
+
+	def testPatchWithRepeatingTargetCopy(self):
+		"""
+		An overlapping TargetCopy repeats a multi-byte pattern.
+		"""
+		iterable = check_stream([
+				ops.Header(0, 9),
+				ops.TargetRead(b'ABC'),
+				ops.TargetCopy(6, 0),
+				ops.SourceCRC32(0x00000000),
+				ops.TargetCRC32(0x02EF56F7),
+			])
+		source = b''
+		target = bytearray(9)
+
+		apply_to_bytearrays(iterable, source, target)
+
+		self.assertSequenceEqual(b'ABCABCABC', target)
+
+	def testLargeTarget(self):
+		"""
+		The target CRC32 is correct when the target spans many CRC32 chunks.
+		"""
+		iterable = check_stream([
+				ops.Header(0, 120000),
+				ops.TargetRead(b'A' * 40000),
+				ops.TargetRead(b'B' * 40000),
+				ops.TargetRead(b'C' * 40000),
+				ops.SourceCRC32(0x00000000),
+				ops.TargetCRC32(0x5E0F3D68),
+			])
+		source = b''
+		target = bytearray(120000)
+
+		apply_to_bytearrays(iterable, source, target)
+
+		self.assertSequenceEqual(
+				b'A' * 40000 + b'B' * 40000 + b'C' * 40000, target)
+
+	def testTargetCRC32Mismatch(self):
+		"""
+		A TargetCRC32 that doesn't match the written data is an error.
+		"""
+		iterable = check_stream([
+				ops.Header(1, 2),
+				ops.SourceRead(1),
+				ops.TargetRead(b'B'),
+				ops.SourceCRC32(0xD3D99E8B),
+				ops.TargetCRC32(0x19F85109),
+			])
+		source = b'A'
+		target = bytearray(2)
+
+		self.assertRaises(CorruptFile, apply_to_bytearrays, iterable,
+				source, target)
+
+	def testPrecalculatedSourceCRC32(self):
+		"""
+		A caller-supplied source CRC32 is used instead of recalculating it.
+		"""
+		iterable = check_stream([
+				ops.Header(1, 1),
+				ops.SourceRead(1),
+				ops.SourceCRC32(0xD3D99E8B),
+				ops.TargetCRC32(0xD3D99E8B),
+			])
+		source = b'A'
+		target = bytearray(1)
+
+		self.assertRaises(CorruptFile, apply_to_bytearrays, iterable,
+				source, target, lambda: 0x12345678)
+
+	def testGrowingTarget(self):
+		"""
+		The target buffer can start out empty and grow as it's written.
+		"""
+		iterable = [
+				ops.SourceRead(1),
+				ops.TargetRead(b'B'),
+				ops.SourceCopy(1, 0),
+				ops.SourceCRC32(crc32(b'A')),
+				ops.TargetCRC32(crc32(b'ABA')),
+			]
+		target = bytearray()
+
+		apply_to_bytearrays(iterable, b'A', target)
+
+		self.assertSequenceEqual(b'ABA', target)
+
+	def testOperationSubclasses(self):
+		"""
+		Subclasses of the operation classes are applied like their parents.
+		"""
+		class MySourceRead(ops.SourceRead):
+			pass
+
+		class MyTargetCRC32(ops.TargetCRC32):
+			pass
+
+		iterable = check_stream([
+				ops.Header(1, 1),
+				MySourceRead(1),
+				ops.SourceCRC32(crc32(b'A')),
+				MyTargetCRC32(0x12345678),
+			])
+		next(iterable)
+		target = bytearray(1)
+
+		# The bad TargetCRC32 is checked, even though it's a subclass.
+		self.assertRaises(CorruptFile, apply_to_bytearrays, iterable, b'A',
+				target)
+		self.assertSequenceEqual(b'A', target)
+
+
+class TestCachedCRC32(unittest.TestCase):
+
+	def testCalculatesOnce(self):
+		"""
+		The CRC32 is calculated on first use, and remembered afterward.
+		"""
+		source = bytearray(b'A')
+		get_crc32 = cached_crc32(source)
+
+		self.assertEqual(get_crc32(), 0xD3D99E8B)
+
+		source[0] = ord('B')
+		self.assertEqual(get_crc32(), 0xD3D99E8B)
+
+	def testUsableForSourceCRC32(self):
+		"""
+		The result can be passed to apply_to_bytearrays for many patches.
+		"""
+		source = b'A'
+		get_crc32 = cached_crc32(source)
+
+		for _ in range(2):
+			target = bytearray(1)
+			apply_to_bytearrays(check_stream([
+					ops.Header(1, 1),
+					ops.SourceRead(1),
+					ops.SourceCRC32(0xD3D99E8B),
+					ops.TargetCRC32(0xD3D99E8B),
+				]), source, target, get_crc32)
+
+			self.assertSequenceEqual(b'A', target)
+
+
+class TestCoalesce(unittest.TestCase):
+
+	def testMergesSourceOperations(self):
+		"""
+		Runs of SourceReads and contiguous SourceCopies are merged.
+		"""
+		original = [
+				ops.Header(6, 9),
+				ops.SourceRead(1),
+				ops.SourceRead(2),
+				ops.SourceCopy(1, 4),
+				ops.SourceCopy(2, 5),
+				ops.SourceCopy(1, 0),
+				ops.TargetRead(b'A'),
+				ops.TargetRead(b'B'),
+				ops.SourceCRC32(0),
+				ops.TargetCRC32(0),
+			]
+
+		expected = [
+				ops.Header(6, 9),
+				ops.SourceRead(3),
+				ops.SourceCopy(3, 4),
+				ops.SourceCopy(1, 0),
+				ops.TargetRead(b'A'),
+				ops.TargetRead(b'B'),
+				ops.SourceCRC32(0),
+				ops.TargetCRC32(0),
+			]
+
+		self.assertSequenceEqual(expected, list(_coalesce(original)))
+
 
 class TestApplyToFiles(unittest.TestCase):
 
@@ -124,6 +324,82 @@ class TestApplyToFiles(unittest.TestCase):
 				actualTarget.getvalue(),
 			)
 
+	def testPatchToRealFile(self):
+		"""
+		We can write the result directly into a real, readable file.
+		"""
+		patch = BytesIO(find_bps("sourcecopy"))
+		source = BytesIO(find_data("sourcecopy.source"))
+		expectedTarget = find_data("sourcecopy.target")
+
+		with TemporaryFile('w+b') as actualTarget:
+			apply_to_files(patch, source, actualTarget)
+
+			self.assertEqual(actualTarget.tell(), len(expectedTarget))
+
+			actualTarget.seek(0)
+			self.assertSequenceEqual(expectedTarget, actualTarget.read())
+
+	def testFailedPatchToRealFile(self):
+		"""
+		A patch that fails to apply doesn't leave partial data in the file.
+		"""
+		patch = BytesIO()
+		write_bps([
+				ops.Header(2, 2),
+				ops.SourceCopy(1, 1),
+				ops.SourceCopy(1, 0),
+				ops.SourceCRC32(0x30694C07),
+				# This is not the CRC32 of b'BA'.
+				ops.TargetCRC32(0x12345678),
+			], patch)
+		patch.seek(0)
+		source = BytesIO(find_data("sourcecopy.source"))
+
+		with TemporaryFile('w+b') as actualTarget:
+			self.assertRaises(CorruptFile, apply_to_files, patch, source,
+					actualTarget)
+
+			actualTarget.seek(0)
+			self.assertEqual(actualTarget.read(), b'')
+
+	def _apply_to_wrong_source(self, target):
+		"""
+		Applies the sourcecopy patch to the wrong source data, into target.
+		"""
+		patch = BytesIO(find_bps("sourcecopy"))
+		source = BytesIO(b'XY')
+
+		self.assertRaises(CorruptFile, apply_to_files, patch, source, target)
+
+	def testFailedPatchToFileWithContent(self):
+		"""
+		A patch that fails to apply doesn't touch a file's existing content.
+		"""
+		with TemporaryDirectory() as tempdir:
+			path = os.path.join(tempdir, "target")
+			with open(path, 'wb') as target:
+				target.write(b'PRECIOUS DATA')
+
+			with open(path, 'r+b') as target:
+				self._apply_to_wrong_source(target)
+
+			with open(path, 'rb') as target:
+				self.assertEqual(target.read(), b'PRECIOUS DATA')
+
+	def testFailedPatchToWriteOnlyFile(self):
+		"""
+		A patch that fails to apply leaves a write-only file empty.
+		"""
+		with TemporaryDirectory() as tempdir:
+			path = os.path.join(tempdir, "target")
+
+			with open(path, 'wb') as target:
+				self._apply_to_wrong_source(target)
+
+			with open(path, 'rb') as target:
+				self.assertEqual(target.read(), b'')
+
 
 if __name__ == "__main__":
 	unittest.main()
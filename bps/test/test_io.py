@@ -9,9 +9,14 @@
 
 import unittest
 from io import BytesIO, StringIO
+import os.path
+from tempfile import TemporaryFile, TemporaryDirectory
 from bps import operations as ops
+from bps import constants as C
 from bps.io import read_bps, write_bps, read_bps_asm, write_bps_asm
 from bps.test.util import find_bps, find_bpsa
+from bps.util import crc32
+from bps.validate import CorruptFile
 
 
 class TestIO(unittest.TestCase):
@@ -20,45 +25,57 @@ class TestIO(unittest.TestCase):
 		"""
 		Test the various interactions for a given patch.
 		"""
+		expectedBPS = find_bps(name)
+		expectedBPSA = find_bpsa(name)
+
 		# Test that we can write the asm version of the patch.
 		out_buf = StringIO()
 		write_bps_asm(eventlist, out_buf)
-		self.assertMultiLineEqual(out_buf.getvalue(), find_bpsa(name))
+		self.assertMultiLineEqual(out_buf.getvalue(), expectedBPSA)
 
 		# Test that we can read the asm version of the patch.
-		in_buf = StringIO(find_bpsa(name))
-		items = list(read_bps_asm(in_buf))
+		in_buf = StringIO(expectedBPSA)
+		asmItems = list(read_bps_asm(in_buf))
 
-		self.assertSequenceEqual(eventlist, items)
+		self.assertSequenceEqual(eventlist, asmItems)
 
 		# Test that we can write the binary patch.
 		out_buf = BytesIO()
 		write_bps(eventlist, out_buf)
-		self.assertSequenceEqual(out_buf.getvalue(), find_bps(name))
+		self.assertSequenceEqual(out_buf.getvalue(), expectedBPS)
+
+		# Test that skipping validation doesn't change what we write.
+		out_buf = BytesIO()
+		write_bps(eventlist, out_buf, validate=False)
+		self.assertSequenceEqual(out_buf.getvalue(), expectedBPS)
+
+		out_buf = StringIO()
+		write_bps_asm(eventlist, out_buf, validate=False)
+		self.assertMultiLineEqual(out_buf.getvalue(), expectedBPSA)
 
 		# Test that we can read the binary patch.
-		in_buf = BytesIO(find_bps(name))
+		in_buf = BytesIO(expectedBPS)
 		items = list(read_bps(in_buf))
 
-		self.assertSequenceEqual(eventlist, items)
-
 		# Test that we can roundtrip the binary version through our reader and
-		# writer.
-		original = BytesIO(find_bps(name))
-		events = read_bps(original)
+		# writer. This has to happen before items are compared with
+		# eventlist: until then, their TargetRead payloads are views of the
+		# patch rather than bytes, so this covers writing those instead of
+		# repeating the write test. Comparing a TargetRead joins its payload
+		# into bytes.
 		output = BytesIO()
-		write_bps(events, output)
+		write_bps(items, output)
 
-		self.assertSequenceEqual(original.getvalue(), output.getvalue())
+		self.assertSequenceEqual(expectedBPS, output.getvalue())
+
+		self.assertSequenceEqual(eventlist, items)
 
 		# Test that we can roundtrip the asm version through our reader and
 		# writer.
-		original = StringIO(find_bpsa(name))
-		events = read_bps_asm(original)
 		output = StringIO()
-		write_bps_asm(events, output)
+		write_bps_asm(asmItems, output)
 
-		self.assertMultiLineEqual(original.getvalue(), output.getvalue())
+		self.assertMultiLineEqual(expectedBPSA, output.getvalue())
 
 	def testEmptyPatch(self):
 		"""
@@ -140,6 +157,161 @@ class TestIO(unittest.TestCase):
 				ops.TargetCRC32(0x9B0D08F1),
 			])
 
+	def testWriteLargePatch(self):
+		"""
+		Buffering and passing big hunks through don't change what we write.
+		"""
+		class RecordingBytesIO(BytesIO):
+			def __init__(self):
+				super().__init__()
+				self.writeCount = 0
+
+			def write(self, data):
+				self.writeCount += 1
+				return super().write(data)
+
+		sourceSize = 200000
+		payload = bytes(range(256)) * 400
+
+		# A TargetRead bigger than write_bps()'s buffer, made of views, is
+		# written straight from its chunks.
+		bigRead = ops.TargetRead(memoryview(payload)[:50000])
+		bigRead.extend(ops.TargetRead(memoryview(payload)[50000:]))
+
+		# Copies from far-apart offsets take several bytes each, so this many
+		# of them fill the buffer and force a flush part-way through.
+		copies = [
+				ops.SourceCopy(1, (i * 7919) % sourceSize)
+				for i in range(30000)
+			]
+
+		hunks = copies + [bigRead, ops.TargetCopy(4, 0), ops.SourceRead(1)]
+		targetSize = sum(hunk.bytespan for hunk in hunks)
+
+		eventlist = [ops.Header(sourceSize, targetSize)]
+		eventlist.extend(hunks)
+		eventlist.append(ops.SourceCRC32(0))
+		eventlist.append(ops.TargetCRC32(0))
+
+		out_buf = RecordingBytesIO()
+		write_bps(eventlist, out_buf)
+
+		# Encode the patch one operation at a time, with no buffering.
+		expected = bytearray()
+		sourceRelativeOffset = 0
+		targetRelativeOffset = 0
+		for item in eventlist:
+			expected += item.encode(sourceRelativeOffset, targetRelativeOffset)
+			if item.opcode == C.OP_SOURCECOPY:
+				sourceRelativeOffset = item.offset + item.bytespan
+			elif item.opcode == C.OP_TARGETCOPY:
+				targetRelativeOffset = item.offset + item.bytespan
+		expected += crc32(expected).to_bytes(4, 'little')
+
+		self.assertEqual(out_buf.getvalue(), expected)
+
+		# Make sure both paths were actually taken: a flush part-way through
+		# the copies, another before the big TargetRead, a write each for its
+		# opcode and its two payload chunks, the final flush, and the patch
+		# CRC32.
+		self.assertGreaterEqual(out_buf.writeCount, 7)
+
+
+class TestReadBPS(unittest.TestCase):
+
+	def testTruncatedTargetRead(self):
+		"""
+		A TargetRead whose data runs off the end of the patch is an error.
+		"""
+		in_buf = BytesIO(find_bps("targetread")[:-13])
+
+		self.assertRaises(CorruptFile, list, read_bps(in_buf))
+
+	def testReadFromRealFile(self):
+		"""
+		A patch in a real file is read the same as one in memory.
+		"""
+		with TemporaryFile() as in_buf:
+			in_buf.write(find_bps("targetread"))
+			in_buf.seek(0)
+
+			items = list(read_bps(in_buf))
+
+			self.assertEqual(in_buf.read(), b'')
+
+		self.assertSequenceEqual(items, [
+				ops.Header(0, 1),
+				ops.TargetRead(b'A'),
+				ops.SourceCRC32(0x00000000),
+				ops.TargetCRC32(0xD3D99E8B),
+			])
+
+	def testRewritePatchFileAfterReading(self):
+		"""
+		The operations read from a patch file don't depend on the file.
+		"""
+		with TemporaryDirectory() as tempdir:
+			path = os.path.join(tempdir, "patch.bps")
+			with open(path, 'wb') as out_buf:
+				out_buf.write(find_bps("targetread"))
+
+			with open(path, 'rb') as in_buf:
+				items = list(read_bps(in_buf))
+
+			# Truncating the file underneath TargetRead payloads that were
+			# views of a mapping of it would crash here.
+			with open(path, 'wb') as out_buf:
+				write_bps(items, out_buf)
+
+			with open(path, 'rb') as in_buf:
+				self.assertEqual(in_buf.read(), find_bps("targetread"))
+
+	def testReadFromEmptyFile(self):
+		"""
+		An empty file is not a patch.
+		"""
+		with TemporaryFile() as in_buf:
+			self.assertRaises(CorruptFile, list, read_bps(in_buf))
+
+
+class TestReadBPSAsm(unittest.TestCase):
+
+	def testUnterminatedText(self):
+		"""
+		A text block without a terminating "." line is an error.
+		"""
+		in_buf = StringIO(
+				"bpsasm\n"
+				"sourcesize: 0\n"
+				"targetsize: 0\n"
+				"metadata:\n"
+				"<test>\n"
+			)
+
+		self.assertRaises(CorruptFile, list, read_bps_asm(in_buf))
+
+	def testTargetReadWithSeparators(self):
+		"""
+		Non-hex characters in TargetRead data are ignored.
+		"""
+		in_buf = StringIO(
+				"bpsasm\n"
+				"sourcesize: 0\n"
+				"targetsize: 3\n"
+				"metadata:\n"
+				".\n"
+				"targetread:\n"
+				"41:42\n"
+				"43\n"
+				".\n"
+				"sourcecrc32: 00000000\n"
+				"targetcrc32: A3830348\n"
+			)
+
+		items = list(read_bps_asm(in_buf))
+
+		self.assertEqual(items[1], ops.TargetRead(b'ABC'))
+
 
 if __name__ == "__main__":
 	unittest.main()
@@ -9,7 +9,9 @@
 
 import sys
 import unittest
+from array import array
 from bps import operations as ops
+from bps import constants as C
 
 class TestHeader(unittest.TestCase):
 
@@ -115,6 +117,13 @@ class TestHeader(unittest.TestCase):
 		op = ops.Header(1, 1, "1")
 		self.assertEqual(op.marker, None)
 
+	def test_no_bytespan(self):
+		"""
+		Headers don't write any bytes to the target.
+		"""
+		op = ops.Header(1, 1, "1")
+		self.assertEqual(op.bytespan, 0)
+
 	def test_cannot_shrink(self):
 		"""
 		The header op cannot be shrunk.
@@ -142,6 +151,16 @@ class TestSourceRead(unittest.TestCase):
 		op = ops.SourceRead(5)
 		self.assertEqual(op.bytespan, 5)
 
+	def test_int_subclass(self):
+		"""
+		The SourceRead op accepts any kind of int as its length.
+		"""
+		class Length(int):
+			pass
+
+		op = ops.SourceRead(Length(5))
+		self.assertEqual(op.bytespan, 5)
+
 	def test_extend_with_SourceRead(self):
 		"""
 		We can extend one SourceRead with another.
@@ -177,6 +196,14 @@ class TestSourceRead(unittest.TestCase):
 		op = ops.SourceRead(5)
 		self.assertEqual(op.encode(0, 0), b'\x90')
 
+		# The longest SourceRead that fits in one byte, and the shortest that
+		# doesn't.
+		op = ops.SourceRead(32)
+		self.assertEqual(op.encode(0, 0), b'\xfc')
+
+		op = ops.SourceRead(33)
+		self.assertEqual(op.encode(0, 0), b'\x00\x80')
+
 	def test_efficiency(self):
 		"""
 		The SourceRead op's efficiency only depends on its length.
@@ -224,6 +251,13 @@ class TestSourceRead(unittest.TestCase):
 		op = ops.SourceRead(1)
 		self.assertEqual(op.marker, 'sr')
 
+	def test_opcode(self):
+		"""
+		SourceRead ops carry the opcode used to encode them.
+		"""
+		op = ops.SourceRead(1)
+		self.assertEqual(op.opcode, C.OP_SOURCEREAD)
+
 	def test_shrink_by_zero(self):
 		"""
 		Shrinking by zero is not allowed.
@@ -290,6 +324,31 @@ class TestTargetRead(unittest.TestCase):
 		self.assertEqual(ops.TargetRead(b'A'  ).bytespan, 1)
 		self.assertEqual(ops.TargetRead(b'AAA').bytespan, 3)
 
+	def test_memoryview_payload(self):
+		"""
+		The TargetRead op can hold a view of its payload without copying it.
+		"""
+		view = memoryview(b'xABCx')[1:4]
+		op = ops.TargetRead(view)
+
+		self.assertIs(op.payload_buffer, view)
+		self.assertEqual(op.bytespan, 3)
+		self.assertEqual(op.payload, b'ABC')
+		self.assertIsInstance(op.payload, bytes)
+
+	def test_unsuitable_memoryview_payload(self):
+		"""
+		The TargetRead op copies views that aren't read-only views of bytes.
+		"""
+		buf = bytearray(b'ABC')
+		op = ops.TargetRead(memoryview(buf))
+		buf[0] = ord('X')
+		self.assertEqual(op.payload, b'ABC')
+
+		op = ops.TargetRead(memoryview(array('I', [1, 2])).toreadonly())
+		self.assertEqual(op.bytespan, 8)
+		self.assertEqual(op.payload, array('I', [1, 2]).tobytes())
+
 	def test_extend_with_TargetRead(self):
 		"""
 		We can extend one TargetRead with another.
@@ -316,6 +375,21 @@ class TestTargetRead(unittest.TestCase):
 		op = ops.TargetRead(b'A')
 		self.assertEqual(op.encode(0, 0), b'\x81A')
 
+		# An extended TargetRead encodes all its chunks as one payload.
+		op.extend(ops.TargetRead(memoryview(b'BC')))
+		self.assertEqual(op.encode(0, 0), b'\x89ABC')
+
+	def test_encode_chunks(self):
+		"""
+		The TargetRead op's encoded chunks join up to its encoding.
+		"""
+		op = ops.TargetRead(b'A')
+		op.extend(ops.TargetRead(b'BC'))
+
+		chunks = op.encode_chunks(0, 0)
+		self.assertEqual(chunks, [b'\x89', b'A', b'BC'])
+		self.assertEqual(b''.join(chunks), op.encode(0, 0))
+
 	def test_efficiency(self):
 		"""
 		The TargetRead op's efficiency only depends on its length.
@@ -367,6 +441,13 @@ class TestTargetRead(unittest.TestCase):
 		op = ops.TargetRead(b'A')
 		self.assertEqual(op.marker, 'tR')
 
+	def test_opcode(self):
+		"""
+		TargetRead ops carry the opcode used to encode them.
+		"""
+		op = ops.TargetRead(b'A')
+		self.assertEqual(op.opcode, C.OP_TARGETREAD)
+
 	def test_shrink_by_zero(self):
 		"""
 		Shrinking by zero is not allowed.
@@ -537,6 +618,11 @@ class TestSourceCopy(CopyOperationTestsMixIn, unittest.TestCase):
 		# the recorded offset will be negative.
 		self.assertEqual(op.encode(3, 0), b'\x82\x83')
 
+		# Lengths and offsets too big for a single byte still encode
+		# correctly.
+		op = ops.SourceCopy(33, 0)
+		self.assertEqual(op.encode(64, 0), b'\x02\x80\x01\x80')
+
 	def test_efficiency(self):
 		"""
 		The SourceCopy op's efficiency depends on length, lastSourceCopyOffset.
@@ -572,6 +658,13 @@ class TestSourceCopy(CopyOperationTestsMixIn, unittest.TestCase):
 		op = ops.SourceCopy(1, 2)
 		self.assertEqual(op.marker, 'Sc')
 
+	def test_opcode(self):
+		"""
+		SourceCopy ops carry the opcode used to encode them.
+		"""
+		op = ops.SourceCopy(1, 2)
+		self.assertEqual(op.opcode, C.OP_SOURCECOPY)
+
 
 class TestTargetCopy(CopyOperationTestsMixIn, unittest.TestCase):
 
@@ -594,6 +687,11 @@ class TestTargetCopy(CopyOperationTestsMixIn, unittest.TestCase):
 		# the recorded offset will be negative.
 		self.assertEqual(op.encode(0, 3), b'\x83\x83')
 
+		# Lengths and offsets too big for a single byte still encode
+		# correctly.
+		op = ops.TargetCopy(33, 0)
+		self.assertEqual(op.encode(0, 64), b'\x03\x80\x01\x80')
+
 	def test_efficiency(self):
 		"""
 		The TargetCopy op's efficiency depends on length, lastTargetCopyOffset.
@@ -629,6 +727,13 @@ class TestTargetCopy(CopyOperationTestsMixIn, unittest.TestCase):
 		op = ops.TargetCopy(1, 2)
 		self.assertEqual(op.marker, 'TC')
 
+	def test_opcode(self):
+		"""
+		TargetCopy ops carry the opcode used to encode them.
+		"""
+		op = ops.TargetCopy(1, 2)
+		self.assertEqual(op.opcode, C.OP_TARGETCOPY)
+
 
 class CRCOperationTestsMixIn:
 
@@ -705,6 +810,13 @@ class CRCOperationTestsMixIn:
 		op = self.constructor(1)
 		self.assertEqual(op.marker, None)
 
+	def test_no_bytespan(self):
+		"""
+		CRC operations don't write any bytes to the target.
+		"""
+		op = self.constructor(1)
+		self.assertEqual(op.bytespan, 0)
+
 	def test_cannot_shrink(self):
 		"""
 		CRC operations cannot be shrunk.
@@ -179,6 +179,51 @@ class TestOptimize(unittest.TestCase):
 
 		self.assertSequenceEqual(expected, actual)
 
+	def testMergeConvertedSourceCopy(self):
+		"""
+		A SourceCopy converted to a SourceRead merges with its neighbours.
+		"""
+		original = [
+				ops.Header(3, 3),
+				ops.SourceRead(1),
+				ops.SourceCopy(1, 1),
+				ops.SourceRead(1),
+				ops.SourceCRC32(0x66A031A7),
+				ops.TargetCRC32(0x66A031A7),
+			]
+
+		expected = [
+				ops.Header(3, 3),
+				ops.SourceRead(3),
+				ops.SourceCRC32(0x66A031A7),
+				ops.TargetCRC32(0x66A031A7),
+			]
+
+		actual = list(test_optimize(original))
+
+		self.assertSequenceEqual(expected, actual)
+
+	def testWithoutValidation(self):
+		"""
+		Skipping validation of an already-valid stream gives the same result.
+		"""
+		def original():
+			# optimize() merges operations in place, so each run needs its
+			# own copies.
+			return [
+					ops.Header(3, 3),
+					ops.SourceRead(1),
+					ops.SourceRead(1),
+					ops.TargetRead(b'A'),
+					ops.SourceCRC32(0x66A031A7),
+					ops.TargetCRC32(0x66A031A7),
+				]
+
+		expected = list(optimize(original()))
+		actual = list(optimize(original(), validate=False))
+
+		self.assertSequenceEqual(expected, actual)
+
 
 if __name__ == "__main__":
 	unittest.main()
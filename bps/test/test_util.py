@@ -9,6 +9,7 @@
 
 import unittest
 import io
+from array import array
 from bps import util
 from zlib import crc32
 
@@ -50,6 +51,31 @@ class TestReadVarInt(unittest.TestCase):
 		self.assertRaises(Exception, util.read_var_int, buf)
 
 
+class TestDecodeVarInt(unittest.TestCase):
+
+	def testDecoding(self):
+		"""
+		Output matches our examples.
+		"""
+		for encoded, decoded in EXAMPLE_VAR_INTS.items():
+			self.assertEqual(
+					util.decode_var_int(encoded, 0),
+					(decoded, len(encoded)),
+				)
+
+	def testDecodeFromOffset(self):
+		"""
+		Decoding starts at the given offset and stops after the high bit.
+		"""
+		self.assertEqual(util.decode_var_int(b"\x10\x00\x80\x10", 1), (128, 3))
+
+	def testDecodeComplainsAboutTruncatedData(self):
+		"""
+		Decoder raises an exception if it can't find the end of a varint.
+		"""
+		self.assertRaises(Exception, util.decode_var_int, b"\x00\x00", 0)
+
+
 class TestWriteVarInt(unittest.TestCase):
 
 	def testEncoding(self):
@@ -105,6 +131,29 @@ class TestCRCIOWrapper(unittest.TestCase):
 		self.assertEqual(stream.read(1), b'b')
 		self.assertEqual(stream.crc32, crc32(b'ab'))
 
+	def testReadInto(self):
+		"""
+		The CRC32 is updated with the data placed in the buffer by readinto.
+		"""
+		buf = io.BytesIO(b'ab')
+		stream = util.CRCIOWrapper(buf)
+		target = bytearray(4)
+
+		self.assertEqual(stream.readinto(target), 2)
+		self.assertEqual(target, b'ab\x00\x00')
+		self.assertEqual(stream.crc32, crc32(b'ab'))
+
+	def testReadIntoWideBuffer(self):
+		"""
+		readinto hashes the bytes it read, even into a buffer of wider items.
+		"""
+		buf = io.BytesIO(b'abcdef')
+		stream = util.CRCIOWrapper(buf)
+		target = array('I', [0, 0])
+
+		self.assertEqual(stream.readinto(target), 6)
+		self.assertEqual(stream.crc32, crc32(b'abcdef'))
+
 	def testProgressiveWrites(self):
 		"""
 		The CRC32 is updated as writes occur.
@@ -6,9 +6,13 @@
 # the COPYING file included with this distribution or
 # http://sam.zoy.org/wtfpl/COPYING for more details.
 
+from functools import lru_cache
 from pkgutil import get_data
 
 
+# Test data never changes during a run, and many tests load the same files,
+# so each file is only read once.
+@lru_cache(maxsize=None)
 def find_data(name):
 	"""
 	Retrieves the raw contents of a file in the test data directory.
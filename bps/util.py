@@ -13,9 +13,17 @@ import sys
 import io
 from array import array
 from time import perf_counter
-from zlib import crc32
+# Everything in this package gets its CRC32 implementation from here, so
+# there's only one place to change if a faster one becomes available.
+try:
+	from zlib import crc32
+except ImportError:
+	# Python can be built without zlib, but binascii always has a table-driven
+	# crc32() written in C, which is far quicker than one in Python.
+	from binascii import crc32
 from bps import constants as C
 
+
 class CRCIOWrapper(io.IOBase):
 	"""
 	A wrapper for an IO instance that tracks the CRC32 of data read or written.
@@ -29,7 +37,9 @@ class CRCIOWrapper(io.IOBase):
 		self.crc32 = 0
 
 	def _update_crc32(self, data):
-		self.crc32 = crc32(data, self.crc32) & 0xffffffff
+		# zlib.crc32() already returns an unsigned value on Python 3, and
+		# folds the whole of data in a single call.
+		self.crc32 = crc32(data, self.crc32)
 		return data
 
 	def __getattr__(self, name):
@@ -74,8 +84,15 @@ class CRCIOWrapper(io.IOBase):
 	def readall(self, *args, **kwargs):
 		return self._update_crc32(self.inner.readall(*args,**kwargs))
 
-	def readinto(self, *args, **kwargs):
-		return self._update_crc32(self.inner.readinto(*args,**kwargs))
+	def readinto(self, buffer):
+		count = self.inner.readinto(buffer)
+		if count:
+			# Hash the part of the caller's buffer that was filled in place,
+			# rather than copying it out first. count is in bytes, so slice a
+			# byte view of the buffer, whatever its item size.
+			with memoryview(buffer) as view, view.cast('B') as byteView:
+				self._update_crc32(byteView[:count])
+		return count
 
 	def write(self, data):
 		return self.inner.write(self._update_crc32(data))
@@ -103,45 +120,74 @@ def read_var_int(handle):
 	return res
 
 
+def decode_var_int(data, offset):
+	"""
+	Decode a variable-length integer from data, starting at offset.
+
+	Returns a tuple of the integer and the offset of the byte after it.
+	"""
+	# Most varints in a patch (small lengths and relative offsets) fit in one
+	# or two bytes, so decode those without entering the general loop.
+	byte = data[offset]
+	if byte & 0x80:
+		return byte & 0x7f, offset + 1
+
+	res = byte + 0x80
+	byte = data[offset + 1]
+	if byte & 0x80:
+		return res + ((byte & 0x7f) << 7), offset + 2
+
+	res += (byte << 7) + 0x4000
+	shift = 0x4000
+	offset += 2
+	while True:
+		byte = data[offset]
+		offset += 1
+		res += (byte & 0x7f) * shift
+		if byte & 0x80: break
+		shift <<= 7
+		res += shift
+
+	return res, offset
+
+
 def encode_var_int(number):
 	"""
 	Returns a bytearray encoding the given number.
 	"""
+	# Most numbers in a patch fit in one or two bytes, so encode those
+	# without entering the general loop.
+	if number < 0x80:
+		return bytearray((number | 0x80,))
+	if number < 0x4080:
+		return bytearray((number & 0x7F, ((number >> 7) - 1) | 0x80))
+
 	buf = bytearray()
-	shift = 1
 
+	# Each byte after the first stands for one more than its value, which is
+	# what lets every number have exactly one encoding.
 	while True:
-		buf.append(number & 0x7F)
-
-		number -= buf[-1]
-
-		if number == 0:
-			buf[-1] |= 0x80
-			break
-
-		number -= shift
+		byte = number & 0x7F
 		number >>= 7
-		shift += 7
 
-	return buf
+		if not number:
+			buf.append(byte | 0x80)
+			return buf
+
+		buf.append(byte)
+		number -= 1
 
 
 def measure_var_int(number):
 	"""
 	Returns the length of the bytearray returned by encode_var_int().
 	"""
-	length = 0
-	shift = 1
-
-	while True:
-		length  += 1
-		number  -= (number & 0x7F)
+	length = 1
+	number >>= 7
 
-		if number == 0: break
-
-		number  -= shift
-		number >>= 7
-		shift   += 7
+	while number:
+		length += 1
+		number = (number - 1) >> 7
 
 	return length
 
@@ -9,6 +9,7 @@
 Tools for validating BPS patches.
 """
 from bps import operations as ops
+from bps import constants as C
 
 
 class CorruptFile(ValueError):
@@ -18,6 +19,10 @@ class CorruptFile(ValueError):
 	pass
 
 
+# Returned by next() when the stream is exhausted; nothing else can be this.
+_END = object()
+
+
 def _check_next(iterable):
 	"""
 	Internal function.
@@ -51,28 +56,41 @@ def check_stream(iterable):
 	targetSize           = header.targetSize
 	targetWriteOffset    = 0
 
+	OP_SOURCEREAD = C.OP_SOURCEREAD
+	OP_TARGETREAD = C.OP_TARGETREAD
+	OP_SOURCECOPY = C.OP_SOURCECOPY
+	OP_TARGETCOPY = C.OP_TARGETCOPY
+
 	while targetWriteOffset < targetSize:
-		item = _check_next(iterable)
+		# This is _check_next() inlined, since it's called for every hunk.
+		item = next(iterable, _END)
+		if item is _END:
+			raise CorruptFile(
+					"truncated patch: expected more opcodes after this.")
+
+		# Anything that isn't a patch hunk has no opcode, or None.
+		opcode = getattr(item, "opcode", None)
+		bytespan = item.bytespan if opcode is not None else 0
 
-		if isinstance(item, ops.SourceRead):
+		if opcode == OP_SOURCEREAD:
 			# This opcode reads from the source file, from targetWriteOffset to
 			# targetWriteOffset+length, so we need to be sure that byte-range
 			# exists in the source file as well as the target.
-			if targetWriteOffset + item.bytespan > sourceSize:
+			if targetWriteOffset + bytespan > sourceSize:
 				raise CorruptFile("bad hunk: reads past the end of the "
 						"source file: {item!r}".format(item=item))
 
-		elif isinstance(item, ops.TargetRead):
+		elif opcode == OP_TARGETREAD:
 			# Nothing special we need to check for this operation.
 			pass
 
-		elif isinstance(item, ops.SourceCopy):
+		elif opcode == OP_SOURCECOPY:
 			# Not allowed to SourceCopy past the end of the source file.
-			if item.offset + item.bytespan > sourceSize:
+			if item.offset + bytespan > sourceSize:
 				raise CorruptFile("bad hunk: reads past the end "
 						"of the source file: {item!r}".format(item=item))
 
-		elif isinstance(item, ops.TargetCopy):
+		elif opcode == OP_TARGETCOPY:
 			# Not allowed to TargetCopy an offset that points past the part
 			# we've written.
 			if item.offset >= targetWriteOffset:
@@ -85,7 +103,7 @@ def check_stream(iterable):
 			raise CorruptFile("bad hunk: unknown opcode {item!r}".format(
 				item=item))
 
-		targetWriteOffset += item.bytespan
+		targetWriteOffset += bytespan
 
 		if targetWriteOffset > targetSize:
 			raise CorruptFile("bad hunk: writes past the end of the target: "